@@ -0,0 +1,61 @@
+"""
+Compare the JSON backends on a synthetic conversation file.
+
+Usage: python bench_serializer.py [--messages 5000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+import serializer
+
+
+def make_conversation(n_messages):
+    rng = random.Random(0)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(2000)]
+    messages = []
+    for i in range(n_messages):
+        text = " ".join(rng.choices(words, k=rng.randint(20, 300)))
+        messages.append({"user": "bot" if i % 2 else "user", "text": text, "length": len(text) // 4})
+    return {"id": "benchmark", "name": "benchmark", "messages": messages}
+
+
+def time_it(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    conversation = make_conversation(args.messages)
+    fd, path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+
+    try:
+        for name in serializer.BACKENDS:
+            if not serializer.is_available(name):
+                print(f"{name:>7}: not installed")
+                continue
+            serializer.set_backend(name)
+            serializer.dump(conversation, path)
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            dump_ms = time_it(lambda: serializer.dump(conversation, path), args.repeat)
+            load_ms = time_it(lambda: serializer.load(path), args.repeat)
+            print(f"{name:>7}: dump {dump_ms:8.2f} ms  load {load_ms:8.2f} ms  ({size_mb:.1f} MB, {args.messages} messages)")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Inference workers for multi-worker deployments.
+
+Each worker process owns one llama model and serves requests over
+multiprocessing.connection (pickled messages over TCP, authenticated with a shared
+key). The API tier talks to workers through WorkerPool, and RemoteLlama stands in for
+llama_cpp.Llama, so the generation code in main.py doesn't care where the model runs.
+
+Conversations are routed to workers by rendezvous hashing on the conversation id over
+the workers holding the current model. Each conversation keeps landing on the same
+worker, which already has its prompt prefix in the KV cache. The mapping only changes
+for conversations on a worker that goes away.
+
+Workers are normally started by `python main.py --inference-workers N` (see launcher.py).
+To run one on another host, start `python inference_worker.py --host 0.0.0.0 --port 9100`
+there with the same CHATBOT_IPC_KEY, and list its address in CHATBOT_INFERENCE_WORKERS.
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+from llama_cpp import Llama, LlamaRAMCache
+
+STATUS_INTERVAL = 2.0
+MAX_IDLE_CONNECTIONS = 4
+
+
+def evaluated_tokens(model):
+    """The tokens in the model's KV cache, or None if its state can't be read (a RemoteLlama)."""
+    if getattr(model, "input_ids", None) is None:
+        return None
+    # input_ids is the whole n_ctx buffer; only the first n_tokens are in the KV cache
+    return model.input_ids[:model.n_tokens].tolist()
+
+
+def longest_token_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class InferenceWorker:
+    def __init__(self, cache_mb=0):
+        self.cache_mb = cache_mb
+        self.model = None
+        self.config = None
+        # A llama context can only run one evaluation at a time
+        self._model_lock = threading.Lock()
+
+    def handle(self, conn):
+        try:
+            while True:
+                request = conn.recv()
+                try:
+                    if request["op"] == "chat":
+                        self.chat(conn, request)
+                    else:
+                        conn.send(getattr(self, "op_" + request["op"])(request))
+                except (EOFError, OSError):
+                    raise
+                except Exception as e:
+                    conn.send({"error": str(e)})
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def op_status(self, request):
+        return {"config": self.config}
+
+    def op_load(self, request):
+        config = request["config"]
+        with self._model_lock:
+            if self.config != config:
+                # Until the new model is up this worker has none, so it mustn't report the old one
+                self.model = None
+                self.config = None
+                model_kwargs = {"model_path": config["model_path"], "verbose": True}
+                if config.get("n_gpu_layers") is not None:
+                    model_kwargs["n_gpu_layers"] = config["n_gpu_layers"]
+                if config.get("context_length") is not None:
+                    model_kwargs["n_ctx"] = config["context_length"]
+                self.model = Llama(**model_kwargs)
+                if self.cache_mb:
+                    # Keeps the KV state of several conversations, not just the last one
+                    self.model.set_cache(LlamaRAMCache(capacity_bytes=self.cache_mb * 1024 * 1024))
+                self.config = config
+        return {"config": self.config, "metadata": self.model.metadata}
+
+    def op_eject(self, request):
+        with self._model_lock:
+            self.model = None
+            self.config = None
+        return {"config": None}
+
+    def op_tokenize(self, request):
+        return {"tokens": self._require_model().tokenize(request["text"], add_bos=request.get("add_bos", True))}
+
+    def op_detokenize(self, request):
+        return {"bytes": self._require_model().detokenize(request["tokens"])}
+
+    def chat(self, conn, request):
+        prompt_stats = None
+        with self._model_lock:
+            model = self._require_model()
+            cache_before = evaluated_tokens(model)
+            response = model.create_chat_completion(messages=request["messages"], stream=True, **request["kwargs"])
+            try:
+                for chunk in response:
+                    if prompt_stats is None:
+                        # The whole prompt has been evaluated by the time the first token comes out
+                        prompt = evaluated_tokens(model)
+                        prompt_stats = {"prompt_tokens": len(prompt),
+                                        "cache_hit_tokens": longest_token_prefix(cache_before, prompt)}
+                    # Anything from the client (a stop, or the connection closing) ends the generation
+                    if conn.poll():
+                        break
+                    conn.send({"chunk": chunk})
+                if prompt_stats is not None:
+                    # Streamed chunks can merge several tokens, so count what was evaluated after the prompt
+                    prompt_stats["completion_tokens"] = len(evaluated_tokens(model)) - prompt_stats["prompt_tokens"]
+            finally:
+                response.close()
+        conn.send({"done": True, "prompt_stats": prompt_stats})
+
+    def _require_model(self):
+        if self.model is None:
+            raise RuntimeError("No model loaded on this inference worker")
+        return self.model
+
+
+def serve(address, authkey, cache_mb=0):
+    worker = InferenceWorker(cache_mb)
+    with Listener(address, authkey=authkey) as listener:
+        print(f"Inference worker listening on {address[0]}:{address[1]}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"Rejected inference worker connection: {e}")
+                continue
+            threading.Thread(target=worker.handle, args=(conn,), daemon=True).start()
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+
+class WorkerPool:
+    def __init__(self, addresses, authkey):
+        self.addresses = [parse_address(a) for a in addresses]
+        self.authkey = authkey
+        self._status = {}
+        self._unreachable = set()
+        self._metadata = None
+        self._monitor = None
+        # Open connections kept for the next request, since each new one costs a TCP and auth handshake
+        self._idle = {}
+        self._idle_lock = threading.Lock()
+
+    def request(self, address, request):
+        while True:
+            conn, reused = self._connect(address)
+            try:
+                conn.send(request)
+                response = conn.recv()
+                break
+            except (EOFError, OSError):
+                conn.close()
+                # An idle connection may have been dropped by a restarted worker; retry on a new one
+                if not reused:
+                    raise
+        self._release(address, conn)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def _connect(self, address):
+        with self._idle_lock:
+            idle = self._idle.get(address)
+            if idle:
+                return idle.pop(), True
+        return Client(address, authkey=self.authkey), False
+
+    def _release(self, address, conn):
+        with self._idle_lock:
+            idle = self._idle.setdefault(address, [])
+            if len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def stream(self, address, request, on_done=None):
+        """
+        Yield chunks from a streaming request. Blocks on the connection between chunks, so
+        async callers should iterate it from a thread. on_done gets the final message.
+        """
+        conn = Client(address, authkey=self.authkey)
+        try:
+            conn.send(request)
+            while True:
+                message = conn.recv()
+                if "error" in message:
+                    raise RuntimeError(message["error"])
+                if message.get("done"):
+                    if on_done is not None:
+                        on_done(message)
+                    return
+                yield message["chunk"]
+        finally:
+            # Closing early tells the worker to stop generating
+            conn.close()
+
+    def status(self):
+        """Loaded model config per reachable worker, as of the last refresh. Never blocks."""
+        return self._status
+
+    def start_monitor(self):
+        """Refresh status() every STATUS_INTERVAL seconds in a background thread."""
+        if self._monitor is None:
+            self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+            self._monitor.start()
+
+    def _monitor_loop(self):
+        while True:
+            self.refresh()
+            time.sleep(STATUS_INTERVAL)
+
+    def refresh(self):
+        # Ask every worker at once, so one unreachable host doesn't hold up the others
+        with ThreadPoolExecutor(max_workers=len(self.addresses)) as executor:
+            results = list(executor.map(lambda address: self._try_request(address, {"op": "status"}), self.addresses))
+        status = {}
+        for address, result in zip(self.addresses, results):
+            if isinstance(result, Exception):
+                # Only log changes, not every poll
+                if address not in self._unreachable:
+                    print(f"Inference worker {address[0]}:{address[1]} is unreachable: {result}")
+                    self._unreachable.add(address)
+                continue
+            if address in self._unreachable:
+                print(f"Inference worker {address[0]}:{address[1]} is reachable again")
+                self._unreachable.discard(address)
+            status[address] = result["config"]
+        self._status = status
+        return status
+
+    def wait_until_ready(self, timeout=60):
+        """Wait for every worker to accept connections. Returns the addresses still unreachable."""
+        pending = list(self.addresses)
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            pending = [a for a in pending if isinstance(self._try_request(a, {"op": "status"}), Exception)]
+            if pending:
+                time.sleep(0.2)
+        return pending
+
+    def _broadcast(self, request):
+        with ThreadPoolExecutor(max_workers=len(self.addresses)) as executor:
+            results = list(executor.map(lambda address: self._try_request(address, request), self.addresses))
+        self.refresh()
+        return results
+
+    def _try_request(self, address, request):
+        try:
+            return self.request(address, request)
+        except Exception as e:
+            return e
+
+    def load(self, config):
+        """Load the model on every worker. Returns the model's GGUF metadata."""
+        results = self._broadcast({"op": "load", "config": config})
+        loaded = [r for r in results if not isinstance(r, Exception)]
+        if not loaded:
+            raise RuntimeError(f"No inference worker could load the model: {results[0]}")
+        self._metadata = loaded[0]["metadata"]
+        return self._metadata
+
+    def eject(self):
+        self._broadcast({"op": "eject"})
+
+    def model_for(self, conversation_id, model_name):
+        """
+        A RemoteLlama on the worker that owns this conversation, chosen by rendezvous
+        hashing among the workers that have model_name loaded.
+        """
+        candidates = [address for address, config in self.status().items()
+                      if config and config["model_name"] == model_name]
+        if not candidates:
+            return None
+        key = str(conversation_id)
+        address = max(candidates, key=lambda a: hashlib.blake2b(f"{key}|{a[0]}:{a[1]}".encode(), digest_size=8).digest())
+        return RemoteLlama(self, address, self._metadata)
+
+
+class RemoteLlama:
+    """The subset of llama_cpp.Llama that main.py uses, forwarded to an inference worker."""
+    def __init__(self, pool, address, metadata=None):
+        self.pool = pool
+        self.address = address
+        self.metadata = metadata or {}
+        # prompt_tokens and cache_hit_tokens of the last completed generation, reported by the worker
+        self.prompt_stats = None
+
+    def tokenize(self, text, add_bos=True):
+        return self.pool.request(self.address, {"op": "tokenize", "text": text, "add_bos": add_bos})["tokens"]
+
+    def detokenize(self, tokens):
+        return self.pool.request(self.address, {"op": "detokenize", "tokens": list(tokens)})["bytes"]
+
+    def create_chat_completion(self, messages, stream=True, **kwargs):
+        if not stream:
+            raise NotImplementedError("Inference workers only support streamed completions")
+        self.prompt_stats = None
+        return self.pool.stream(self.address, {"op": "chat", "messages": messages, "kwargs": kwargs},
+                                on_done=lambda message: setattr(self, "prompt_stats", message.get("prompt_stats")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a standalone inference worker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--cache-mb", type=int, default=0, help="RAM for cached KV states of inactive conversations")
+    args = parser.parse_args(argv)
+
+    authkey = os.environ.get("CHATBOT_IPC_KEY")
+    if not authkey:
+        raise SystemExit("CHATBOT_IPC_KEY must be set to the key the API tier uses")
+    serve((args.host, args.port), authkey.encode(), args.cache_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+In-memory cache for small JSON files (app settings, model metadata).
+
+Reads come from memory. Writers go through edit(), which holds the store's lock, so two
+handlers updating different keys can't overwrite each other's changes. Dirty data is
+written back atomically after a short debounce, so several updates in a row (like
+dragging a slider in the settings panel) cost one disk write. flush() forces the write
+immediately and raises if the file can't be written; so does edit() in shared mode, where
+every edit is written through. All stores are flushed at interpreter exit.
+
+Unless the store is shared (below), the file is only read once, at startup. Changes
+made to it by hand while the backend is running will be overwritten.
+
+With shared=True (several API worker processes), edits take a lock file, re-read the
+file if another process changed it, and write through immediately. Reads stat the file
+and reload it if another process has written it since.
+"""
+import atexit
+import copy
+import os
+import threading
+from contextlib import contextmanager
+
+import serializer
+from file_lock import FileLock
+
+_stores = []
+
+
+class JsonStore:
+    def __init__(self, path, default=None, indent=False, debounce_ms=200, shared=False):
+        self.path = path
+        self.indent = indent
+        self.shared = shared
+        self.debounce = 0 if shared else debounce_ms / 1000
+        self._lock = FileLock(path + ".lock") if shared else threading.RLock()
+        self._timer = None
+        self._dirty = False
+        self._stat = None
+
+        with self._lock:
+            if os.path.exists(path):
+                self._data = serializer.load(path)
+                self._stat = self._file_stat()
+            else:
+                self._data = copy.deepcopy(default) if default is not None else {}
+                self._write()
+        _stores.append(self)
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _reload_if_changed(self):
+        if self.shared and not self._dirty and self._file_stat() != self._stat:
+            with self._lock:
+                self._data = serializer.load(self.path)
+                self._stat = self._file_stat()
+
+    def _write(self):
+        serializer.dump(self._data, self.path, indent=self.indent)
+        self._stat = self._file_stat()
+
+    @property
+    def data(self):
+        """The cached contents. Treat as read-only; use edit() to change it."""
+        self._reload_if_changed()
+        return self._data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.edit() as data:
+            data[key] = value
+
+    @contextmanager
+    def edit(self):
+        with self._lock:
+            self._reload_if_changed()
+            yield self._data
+            self._dirty = True
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.debounce <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.debounce, self._flush_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write pending changes now. Raises if the file can't be written."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            self._write()
+            self._dirty = False
+
+    def _flush_in_background(self):
+        # Nobody is waiting on a debounced write, so all that can be done is log it.
+        # The data stays dirty and is written again by the next flush.
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Failed to write {self.path}: {e}")
+
+
+def flush_all():
+    for store in _stores:
+        store._flush_in_background()
+
+
+atexit.register(flush_all)
@@ -0,0 +1,96 @@
+"""
+Command line entry point of the backend.
+
+`python main.py` serves the app from a single process. With --workers or
+--inference-workers it becomes a launcher: it starts the inference workers as separate
+processes, waits for them, and then runs uvicorn with several API worker processes.
+The children learn their role from environment variables (CHATBOT_API_WORKERS,
+CHATBOT_INFERENCE_WORKERS and CHATBOT_IPC_KEY) when main.py is imported.
+
+main.py calls this before any of its own setup runs, so the launcher and the inference
+worker processes never open the settings, the conversation store or the trace log.
+"""
+import argparse
+import os
+import secrets
+import subprocess
+import sys
+
+import uvicorn
+
+import inference_worker
+from inference_worker import WorkerPool
+
+INFERENCE_WORKER_FLAG = "--inference-worker"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SavorSauce chatbot backend")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="API worker processes")
+    parser.add_argument("--inference-workers", type=int, default=0,
+                        help="Processes that each hold a copy of the model (0 runs the model in the API process)")
+    parser.add_argument("--inference-port", type=int, default=9100, help="First local port for inference workers")
+    parser.add_argument("--cache-mb", type=int, default=0, help="RAM per inference worker for cached KV states")
+    return parser.parse_args(argv)
+
+
+def main(script):
+    """
+    Handle the command line of main.py (`script`). Returns the parsed arguments when the
+    app should be served from this process; otherwise runs the requested processes and exits.
+    """
+    argv = sys.argv[1:]
+    if argv[:1] == [INFERENCE_WORKER_FLAG]:
+        inference_worker.main(argv[1:])
+        sys.exit()
+
+    args = parse_args(argv)
+    if args.workers <= 1 and args.inference_workers <= 0:
+        return args
+    launch(args, script)
+    sys.exit()
+
+
+def worker_command(script):
+    # A frozen build is a single executable, so workers are started through main.py's flag either way
+    if getattr(sys, "frozen", False):
+        return [sys.executable, INFERENCE_WORKER_FLAG]
+    return [sys.executable, script, INFERENCE_WORKER_FLAG]
+
+
+def launch(args, script):
+    external_workers = os.environ.get("CHATBOT_INFERENCE_WORKERS")
+    if args.workers > 1 and args.inference_workers <= 0 and not external_workers:
+        # Each API worker would otherwise hold its own model, and only the one that handled
+        # /set_model would have it loaded
+        print("Several API workers need a shared model; starting one inference worker")
+        args.inference_workers = 1
+    if external_workers and args.inference_workers > 0:
+        print(f"Using the inference workers in CHATBOT_INFERENCE_WORKERS instead of starting {args.inference_workers}")
+        args.inference_workers = 0
+
+    # Inherited by every child process
+    authkey = os.environ.setdefault("CHATBOT_IPC_KEY", secrets.token_hex(32))
+    os.environ["CHATBOT_API_WORKERS"] = str(args.workers)
+
+    processes = []
+    addresses = []
+    try:
+        for i in range(args.inference_workers):
+            port = args.inference_port + i
+            processes.append(subprocess.Popen(worker_command(script) + [
+                "--host", "127.0.0.1", "--port", str(port), "--cache-mb", str(args.cache_mb)]))
+            addresses.append(f"127.0.0.1:{port}")
+        if addresses:
+            os.environ["CHATBOT_INFERENCE_WORKERS"] = ",".join(addresses)
+            # API workers load the default model on startup, so the workers must be listening first
+            unreachable = WorkerPool(addresses, authkey.encode()).wait_until_ready()
+            if unreachable:
+                raise SystemExit(f"Inference workers did not start: {unreachable}")
+
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        for process in processes:
+            process.terminate()
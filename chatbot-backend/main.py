@@ -1,6 +1,16 @@
 import asyncio
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+import re
+import zlib
+from collections import Counter
+from logging.handlers import RotatingFileHandler
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Body, Query, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from pathlib import Path
 import os
@@ -10,6 +20,23 @@ import uvicorn
 import shutil
 import subprocess
 from llama_cpp import Llama
+import serializer
+from search_index import SearchIndex
+from rag import Recall
+from json_store import JsonStore
+from file_lock import FileLock
+from concurrent.futures import ThreadPoolExecutor
+from inference_worker import WorkerPool, evaluated_tokens, longest_token_prefix
+import launcher
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Worker processes of a frozen build re-run this executable
+    # Launcher and inference worker processes exit here, before any of the setup below
+    launch_args = launcher.main(os.path.abspath(__file__))
+elif __name__ == "__mp_main__":
+    # Spawned API worker processes re-run this script as __mp_main__ before uvicorn imports
+    # "main:app". Registering this copy as "main" keeps the setup below from running twice.
+    sys.modules.setdefault("main", sys.modules[__name__])
 
 # Define paths and directories
 conversations_dir = "conversations"
@@ -17,36 +44,65 @@ models_dir = "models"
 model_metadata_file = os.path.join(models_dir, "model_metadata.json")
 index_file = os.path.join(conversations_dir, "index.json")
 settings_file_path = "app_settings.json"
+logs_dir = "logs"
 
 # Ensure directories exist
 os.makedirs(conversations_dir, exist_ok=True)
 os.makedirs(models_dir, exist_ok=True)
 
-# Initialize settings if file does not exist
-if not os.path.exists(settings_file_path):
-    settings = {
-        "conversations_dir": conversations_dir,
-        "models_dir": models_dir,
-        "model_metadata_file": model_metadata_file,
-        "index_file": index_file,
-        "theme": "quartz",
-        "default_model": {},
-        "load_on_startup": False,
-        "chat_params": {
-            "system_prompt": "Your system prompt here",
-            "temperature": 0.2,
-            "top_p": 0.95,
-            "top_k": 40
-        }
+# Default settings, written out if the settings file does not exist
+default_settings = {
+    "conversations_dir": conversations_dir,
+    "models_dir": models_dir,
+    "model_metadata_file": model_metadata_file,
+    "index_file": index_file,
+    "theme": "quartz",
+    "default_model": {},
+    "load_on_startup": False,
+    "chat_params": {
+        "system_prompt": "Your system prompt here",
+        "temperature": 0.2,
+        "top_p": 0.95,
+        "top_k": 40
+    },
+    "tracing": {
+        "enabled": True,
+        "max_bytes": 10 * 1024 * 1024,
+        "backup_count": 5,
+        "profile_slow_generations": False,
+        "slow_threshold_ms": 10000,
+        "profile_interval_ms": 10
+    },
+    "rag": {
+        "enabled": False,
+        "top_k": 4,
+        "token_budget": 512,
+        "min_score": 0.35,
+        "batch_size": 16,
+        "embedding_model": None,
+        "embedding_gpu_layers": 0
     }
-    with open(settings_file_path, 'w') as f:
-        json.dump(settings, f, indent=2)
-
-# Load settings from app_settings.json
-with open(settings_file_path, 'r') as f:
-    settings = json.load(f)
-
-app = FastAPI()
+}
+
+# DEPLOYMENT
+# Set by `python main.py --workers N --inference-workers M` (see launcher.py).
+# Module globals are per process, so with several API workers the shared state is kept in
+# app_settings.json and conversation files are written under a lock file.
+api_workers = int(os.environ.get("CHATBOT_API_WORKERS", "1"))
+shared_storage = api_workers > 1
+inference_addresses = [a for a in os.environ.get("CHATBOT_INFERENCE_WORKERS", "").split(",") if a]
+worker_pool = None
+if inference_addresses:
+    worker_pool = WorkerPool(inference_addresses, os.environ.get("CHATBOT_IPC_KEY", "").encode())
+    # Worker status is polled in the background; requests only read the last result
+    worker_pool.start_monitor()
+
+# Load settings from app_settings.json (cached in memory, see json_store.py)
+settings_store = JsonStore(settings_file_path, default=default_settings, indent=True, shared=shared_storage)
+settings = settings_store.data
+
+# orjson renders responses several times faster than the default encoder when it is installed
+app = FastAPI(default_response_class=ORJSONResponse if serializer.backend == "orjson" else JSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -66,6 +122,7 @@ conversations_dir = settings['conversations_dir']
 models_dir = settings['models_dir']
 model_metadata_file = settings['model_metadata_file']
 index_file = settings['index_file']
+logs_dir = settings.get('logs_dir', logs_dir)
 
 class LlamaModel(BaseModel):
     model_name: str
@@ -74,7 +131,8 @@ class LlamaModel(BaseModel):
     context_length: int
 
 # Models
-current_model = LlamaModel(model_name="No model selected", use_cuda=False, n_gpu_layers=0, context_length=512)  # Changes to default on startup (if enabled)
+NO_MODEL = LlamaModel(model_name="No model selected", use_cuda=False, n_gpu_layers=0, context_length=512)
+current_model = NO_MODEL  # Changes to default on startup (if enabled)
 default_model = settings['default_model']
 load_on_startup = settings['load_on_startup']
 
@@ -83,12 +141,12 @@ llama_model = None
 # Ensure the conversations directory and index file exist
 os.makedirs(conversations_dir, exist_ok=True)
 if not os.path.exists(index_file):
-    with open(index_file, 'w') as f:
-        json.dump({}, f)
+    serializer.dump({}, index_file)
 
-if not os.path.exists(model_metadata_file):
-    with open(model_metadata_file, 'w') as f:
-        json.dump({}, f)
+# Guards index.json and conversation files against concurrent writers in other API workers
+storage_lock = FileLock(os.path.join(conversations_dir, ".lock"))
+
+metadata_store = JsonStore(model_metadata_file, default={}, indent=True, shared=shared_storage)
 
 class Message(BaseModel):
     user: str
@@ -117,21 +175,15 @@ class FilePath(BaseModel):
     path: str
 
 # CHAT PARAMETERS
-chat_params = ChatParams(system_prompt=settings['chat_params']['system_prompt'])
+chat_params = ChatParams(**settings['chat_params'])
 
 @app.post("/update-theme")
 async def update_theme(theme: Theme):
     try:
-        # Read the current app settings
-        with open(settings_file_path, "r") as f:
-            app_settings = json.load(f)
-
         # Update the theme in the settings, storing it in lowercase
-        app_settings["theme"] = theme.themePath.lower()
-
-        # Write the updated settings back to the file
-        with open(settings_file_path, "w") as f:
-            json.dump(app_settings, f, indent=4)
+        settings_store.set("theme", theme.themePath.lower())
+        # One-off settings are written now rather than debounced, so a failed write gets reported
+        settings_store.flush()
 
         return {"message": "Theme updated successfully"}
     except Exception as e:
@@ -147,21 +199,14 @@ async def load_from_path(request: Request):
 
     results = []
 
-    with open(model_metadata_file, 'r+') as f:
-        metadata = json.load(f)
-
     for path in paths:
         name = os.path.basename(path).split('.')[0]
-        if name in metadata:
+        if name in metadata_store.data:
             results.append({"message": f"Model '{name}' already exists and was skipped."})
             continue
         try:
             # Update models.json file
-            with open(model_metadata_file, 'r+') as f:
-                metadata[name] = {"path": path}
-                f.seek(0)
-                json.dump(metadata, f, indent=2)
-                f.truncate()
+            metadata_store.set(name, {"path": path})
 
             results.append({"message": f"Model '{name}' loaded from path '{path}' successfully."})
         except Exception as e:
@@ -174,9 +219,7 @@ async def load_from_path(request: Request):
 async def delete_model(request: DeleteModelRequest):
     path = request.path
     try:
-        # Load the metadata file
-        with open(model_metadata_file, 'r') as f:
-            metadata = json.load(f)
+        metadata = metadata_store.data
 
         if path in metadata:
             model_data = metadata[path]
@@ -189,11 +232,8 @@ async def delete_model(request: DeleteModelRequest):
                     shutil.rmtree(model_path)
             
             # Remove the entry from metadata
-            del metadata[path]
-            
-            # Write the updated metadata back to the file
-            with open(model_metadata_file, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            with metadata_store.edit() as metadata:
+                metadata.pop(path, None)
 
             return {"message": f"Model '{path}' deleted successfully."}
         else:
@@ -205,32 +245,22 @@ async def delete_model(request: DeleteModelRequest):
 
 @app.post("/upload")
 async def upload_model(files: list[UploadFile] = File(...)):
-    with open(model_metadata_file, 'r') as f:
-        metadata = json.load(f)
-
     for file in files:
         model_name = file.filename.split('.')[0]
-        if model_name in metadata:
+        if model_name in metadata_store.data:
             continue
         file_location = Path(models_dir) / file.filename
         with open(file_location, "wb") as f:
             shutil.copyfileobj(file.file, f)
-        metadata[model_name] = {"path": None}
-    
-    with open(model_metadata_file, 'w') as f:
-        json.dump(metadata, f, indent=2)
+        metadata_store.set(model_name, {"path": None})
     
     return {"message": "Files uploaded successfully!"}
 
 @app.get("/current_theme", response_model=Theme)
 async def get_current_theme():
     try:
-        # Read the current app settings
-        with open(settings_file_path, "r") as f:
-            app_settings = json.load(f)
-
         # Get the current theme from the settings
-        theme_path = app_settings.get("theme")
+        theme_path = settings_store.get("theme")
         
         if not theme_path:
             raise HTTPException(status_code=404, detail="Theme not found")
@@ -250,24 +280,17 @@ async def edit_chat_params(params: ChatParams):
     chat_params = params
 
     # Update the settings in app_settings.json
-    with open('app_settings.json', 'r') as settings_file:
-        settings = json.load(settings_file)
-
-    settings['chat_params']['system_prompt'] = chat_params.system_prompt
-
-    with open('app_settings.json', 'w') as settings_file:
-        json.dump(settings, settings_file)
+    with settings_store.edit() as app_settings:
+        app_settings['chat_params'] = {**app_settings['chat_params'], **chat_params.model_dump()}
 
     return chat_params
 
 
 def read_index():
-    with open(index_file, 'r') as f:
-        return json.load(f)
+    return serializer.load(index_file)
 
 def write_index(index):
-    with open(index_file, 'w') as f:
-        json.dump(index, f)
+    serializer.dump(index, index_file)
 
 def get_conversation_filename(conversation_id):
     index = read_index()
@@ -276,31 +299,77 @@ def get_conversation_filename(conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found")
     return filename
 
+def update_conversation(conversation_id, update):
+    """
+    Load a conversation, apply update(conversation) and save it under the storage lock,
+    so a message saved by another API worker in the meantime isn't lost.
+    """
+    with storage_lock:
+        file_path = os.path.join(conversations_dir, get_conversation_filename(conversation_id))
+        conversation = serializer.load(file_path)
+        update(conversation)
+        serializer.dump(conversation, file_path)
+    return conversation
+
+def set_message(conversation, message_index, message):
+    conversation["messages"][message_index] = message
+
+# Full-text search over every message, kept up to date wherever messages are saved
+search_index = SearchIndex(os.path.join(conversations_dir, "search.db"))
+_startup_index = read_index()
+search_index.sync({conversation_id: os.path.join(conversations_dir, filename)
+                   for conversation_id, filename in _startup_index.items()},
+                  serializer.load)
+
+# Recall of earlier conversations (RAG), off unless enabled in app_settings.json
+rag_settings = {**default_settings['rag'], **settings.get('rag', {})}
+recall = None
+if rag_settings['enabled'] and (shared_storage or worker_pool is not None):
+    # The vector index has a single writer and embeds with an in-process model
+    print("Recall of earlier conversations is not supported with multiple workers and has been disabled")
+elif rag_settings['enabled']:
+    recall = Recall(os.path.join(conversations_dir, "embeddings"),
+                    batch_size=rag_settings['batch_size'],
+                    all_messages=search_index.all_messages)
+    # A dedicated embedding GGUF is loaded once; otherwise the chat model is reopened for embeddings
+    # on every model change. Either way it runs on the CPU unless embedding_gpu_layers says otherwise.
+    if rag_settings['embedding_model']:
+        recall.set_model(Path(rag_settings['embedding_model']).stem, rag_settings['embedding_model'],
+                         rag_settings['embedding_gpu_layers'])
+
+def index_message(conversation_id, message_index, message):
+    search_index.set_message(conversation_id, message_index, message)
+    if recall is not None:
+        recall.enqueue(conversation_id, message_index, message["text"])
+
+def index_conversations(conversations):
+    # Bulk version of index_message for whole conversations (used by /import)
+    search_index.index_conversations(conversations)
+    if recall is not None:
+        for conversation in conversations:
+            recall.remove_conversation(conversation["id"])
+            for message_index, message in enumerate(conversation["messages"]):
+                recall.enqueue(conversation["id"], message_index, message["text"])
+
+def forget_conversation(conversation_id):
+    search_index.delete_conversation(conversation_id)
+    if recall is not None:
+        recall.remove_conversation(conversation_id)
+
 def is_conversation_name_taken(name):
     index = read_index()
     for filename in index.values():
         file_path = os.path.join(conversations_dir, filename)
-        with open(file_path, 'r') as f:
-            conversation = json.load(f)
-            if conversation["name"] == name:
-                return True
+        conversation = serializer.load(file_path)
+        if conversation["name"] == name:
+            return True
     return False
 
-def initialize_metadata_file():
-    # Initialize an empty metadata file if it doesn't exist
-    with open(model_metadata_file, 'w') as json_file:
-        json.dump({}, json_file)
-
 # Initialize the LLAMA model
 def init_model(model_name, use_cuda, n_gpu_layers, context_length):
     global current_model
 
-    # Check if model metadata exists in the JSON file
-    if not os.path.exists(model_metadata_file):
-        initialize_metadata_file()
-    
-    with open(model_metadata_file, 'r') as json_file:
-        metadata = json.load(json_file)
+    metadata = metadata_store.data
 
     # Initialize the model path based on metadata
     if model_name in metadata and 'path' in metadata[model_name] and metadata[model_name]['path'] is not None:
@@ -324,7 +393,18 @@ def init_model(model_name, use_cuda, n_gpu_layers, context_length):
     if context_length is not None:
         model_kwargs["n_ctx"] = context_length
 
-    model = Llama(**model_kwargs)
+    if worker_pool is not None:
+        worker_pool.load({"model_name": model_name,
+                          "model_path": model_path,
+                          "use_cuda": use_cuda,
+                          "n_gpu_layers": model_kwargs.get("n_gpu_layers"),
+                          "context_length": context_length})
+        model = worker_pool.model_for(None, model_name)
+    else:
+        model = Llama(**model_kwargs)
+
+    if recall is not None and not rag_settings['embedding_model']:
+        recall.set_model(model_name, model_path, rag_settings['embedding_gpu_layers'])
 
     current_model = LlamaModel(model_name=model_name,
                                use_cuda=use_cuda,
@@ -337,18 +417,15 @@ def init_model(model_name, use_cuda, n_gpu_layers, context_length):
         # Convert string numbers to integers
         model_metadata = convert_strings_to_ints(model_metadata)
 
-        # Check if metadata already exists and only update non-path attributes
-        if model_name in metadata:
-            existing_metadata = metadata[model_name]
-            if 'path' in existing_metadata:
-                model_metadata['path'] = existing_metadata['path']
-
-        # Update metadata
-        metadata[model_name] = model_metadata
+        with metadata_store.edit() as metadata:
+            # Check if metadata already exists and only update non-path attributes
+            if model_name in metadata:
+                existing_metadata = metadata[model_name]
+                if 'path' in existing_metadata:
+                    model_metadata['path'] = existing_metadata['path']
 
-        # Write updated metadata back to the file
-        with open(model_metadata_file, 'w') as json_file:
-            json.dump(metadata, json_file, indent=2)
+            # Update metadata
+            metadata[model_name] = model_metadata
 
     return model
 
@@ -365,50 +442,84 @@ def convert_strings_to_ints(d):
 
 
 def get_metadata(model_name):
-    try:
-        with open(model_metadata_file, 'r') as json_file:
-            metadata = json.load(json_file)
-            model_metadata = metadata.get(model_name, None)
-            
-            if model_metadata and len(model_metadata) == 1 and 'path' in model_metadata:
-                return None  # Return None if only 'path' attribute exists
-            
-            return model_metadata
-        
-    except FileNotFoundError:
-        return None
+    model_metadata = metadata_store.get(model_name)
+
+    if model_metadata and len(model_metadata) == 1 and 'path' in model_metadata:
+        return None  # Return None if only 'path' attribute exists
+
+    return model_metadata
 
 @app.get("/{model_name}/metadata")
 async def get_model_metadata(model_name: str):
     model_metadata = get_metadata(model_name)
     return model_metadata
 
-# Load the model once during startup
-if load_on_startup:
-    llama_model = init_model(model_name=settings['model_name'], use_cuda=settings['use_cuda'], n_gpu_layers=settings['n_gpu_layers'], context_length=settings['context_length'])
+def model_for(conversation_id):
+    # With inference workers, each conversation sticks to one worker so its KV cache is reused
+    if worker_pool is not None and llama_model is not None:
+        return worker_pool.model_for(conversation_id, current_model.model_name) or llama_model
+    return llama_model
+
+def refresh_shared_state():
+    """
+    Pick up changes other API workers made to the settings and the loaded model.
+    Does nothing in the default single-process mode.
+    """
+    global chat_params, default_model, load_on_startup, current_model, llama_model
+    if shared_storage:
+        chat_params = ChatParams(**settings_store.get('chat_params'))
+        default_model = settings_store.get('default_model')
+        load_on_startup = settings_store.get('load_on_startup')
+    if worker_pool is not None:
+        configs = [config for config in worker_pool.status().values() if config]
+        if not configs:
+            # Ejected by another API worker
+            llama_model = None
+            current_model = NO_MODEL
+        elif llama_model is None or current_model.model_name != configs[0]["model_name"]:
+            config = configs[0]
+            current_model = LlamaModel(model_name=config["model_name"],
+                                       use_cuda=config["use_cuda"],
+                                       n_gpu_layers=config["n_gpu_layers"] or 0,
+                                       context_length=config["context_length"])
+            llama_model = worker_pool.model_for(None, config["model_name"])
+
+@app.middleware("http")
+async def refresh_shared_state_middleware(request: Request, call_next):
+    refresh_shared_state()
+    return await call_next(request)
+
+# Load the default model once during startup. This runs in every process that serves the
+# app; inference workers that already have the model loaded treat it as a no-op.
+@app.on_event("startup")
+async def load_default_model():
+    global llama_model
+    if load_on_startup and default_model:
+        try:
+            llama_model = init_model(**default_model)
+        except Exception as e:
+            # A missing model file shouldn't keep the app from starting; one can be picked in the UI
+            print(f"Failed to load default model {default_model.get('model_name')}: {e}")
 
 @app.post("/conversations")
 async def create_conversation():
-    index = read_index()
     new_id = str(uuid.uuid4())
     filename = f"conversation_{new_id}.json"
     file_path = os.path.join(conversations_dir, filename)
     conversation = {"id": new_id, "name": f"conversation_{new_id}", "messages": []}
-    with open(file_path, 'w') as f:
-        json.dump(conversation, f)
-    index[new_id] = filename
-    write_index(index)
+    serializer.dump(conversation, file_path)
+    with storage_lock:
+        index = read_index()
+        index[new_id] = filename
+        write_index(index)
     return conversation
 
 @app.put("/settings/load_on_startup")
 async def set_load_on_startup(request: LoadOnStartupRequest):
     global load_on_startup
     load_on_startup = request.load_on_startup
-    with open('app_settings.json', 'r') as settings_file:
-        settings = json.load(settings_file)
-    settings['load_on_startup'] = load_on_startup
-    with open('app_settings.json', 'w') as settings_file:
-        json.dump(settings, settings_file)
+    settings_store.set('load_on_startup', load_on_startup)
+    settings_store.flush()
     return {"load_on_startup": load_on_startup}
 
 @app.get("/settings/load_on_startup")
@@ -425,11 +536,8 @@ async def edit_default_model(model_name: str, use_cuda: bool = False, n_gpu_laye
         "n_gpu_layers": n_gpu_layers,
         "context_length": context_length
     }
-    with open('app_settings.json', 'r') as settings_file:
-        settings = json.load(settings_file)
-    settings['default_model'] = default_model
-    with open('app_settings.json', 'w') as settings_file:
-        json.dump(settings, settings_file)
+    settings_store.set('default_model', default_model)
+    settings_store.flush()
     return {"default_model": default_model}
 
 @app.get("/default_model")
@@ -447,9 +555,8 @@ async def list_conversations():
     conversations = []
     for conversation_id, filename in index.items():
         try:
-            with open(os.path.join(conversations_dir, filename), 'r') as f:
-                conversation = json.load(f)
-                conversations.append({"id": conversation["id"], "name": conversation["name"]})
+            conversation = serializer.load(os.path.join(conversations_dir, filename))
+            conversations.append({"id": conversation["id"], "name": conversation["name"]})
         except json.JSONDecodeError:
             print(f"File {filename} is not a valid JSON")
     return conversations
@@ -459,8 +566,7 @@ async def get_conversation(conversation_id: str):
     filename = get_conversation_filename(conversation_id)
     file_path = os.path.join(conversations_dir, filename)
     
-    with open(file_path, 'r') as f:
-        conversation = json.load(f)
+    conversation = serializer.load(file_path)
     
     # Calculate the total length of all messages
     total_length = sum(message['length'] for message in conversation['messages'])
@@ -476,14 +582,11 @@ async def get_conversation(conversation_id: str):
 @app.get("/models")
 async def list_models():
     try:
-        with open(model_metadata_file, 'r') as f:
-            metadata = json.load(f)
-        
         # Extract model names from metadata keys where path attribute is None or path exists
         model_names_to_remove = []
         model_names = []
         
-        for model_name, model_data in metadata.items():
+        for model_name, model_data in list(metadata_store.data.items()):
             if model_data['path'] is None:
                 default_path = f"./{models_dir}/{model_name}.gguf"
                 if os.path.exists(default_path):
@@ -495,14 +598,11 @@ async def list_models():
             else:
                 model_names_to_remove.append(model_name)
 
-        # Remove entries from metadata
-        for model_name in model_names_to_remove:
-            del metadata[model_name]
-
-        # Write updated metadata back to the file if any entries were removed
+        # Remove entries from metadata, which writes it back to the file if any were removed
         if len(model_names_to_remove) > 0:
-            with open(model_metadata_file, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            with metadata_store.edit() as metadata:
+                for model_name in model_names_to_remove:
+                    metadata.pop(model_name, None)
         
         return model_names
     
@@ -544,8 +644,12 @@ async def eject_model():
             raise HTTPException(status_code=400, detail="No model to eject from memory.")
 
         # Simulate the model ejection
+        if worker_pool is not None:
+            worker_pool.eject()
         llama_model = None
-        current_model = None
+        current_model = NO_MODEL
+        if recall is not None and not rag_settings['embedding_model']:
+            recall.unload()
         return {"message": "Model successfully ejected from memory"}
     
     except Exception as e:
@@ -555,20 +659,30 @@ async def eject_model():
 
 @app.post("/conversations/{conversation_id}/messages/user")
 async def add_user_message(conversation_id: str, message: Message):
-    filename = get_conversation_filename(conversation_id)
-    file_path = os.path.join(conversations_dir, filename)
-    with open(file_path, 'r') as f:
-        conversation = json.load(f)
-
-    message_length = count_prompt_tokens(llama_model, message.text)
+    get_conversation_filename(conversation_id)  # 404 before spending time on tokenization
 
-    conversation["messages"].append({"user": message.user, "text": message.text, "length": message_length})
+    # Off the event loop: with inference workers this is a round trip to a worker
+    message_length = await asyncio.to_thread(count_prompt_tokens, llama_model, message.text)
+    user_message = {"user": message.user, "text": message.text, "length": message_length}
 
-    with open(file_path, 'w') as f:
-        json.dump(conversation, f)
+    conversation = update_conversation(conversation_id, lambda c: c["messages"].append(user_message))
+    index_message(conversation_id, len(conversation["messages"]) - 1, user_message)
     return conversation
 
-async def async_generator(generator):
+# Threads that wait on inference workers for the next chunk of a response
+stream_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="inference-stream")
+
+async def async_generator(generator, in_thread=False):
+    if in_thread:
+        # Chunks from an inference worker arrive over a blocking connection; wait for them off the event loop
+        loop = asyncio.get_running_loop()
+        iterator = iter(generator)
+        done = object()
+        while True:
+            item = await loop.run_in_executor(stream_executor, next, iterator, done)
+            if item is done:
+                return
+            yield item
     for item in generator:
         await asyncio.sleep(0)  # Yield control to the event loop
         yield item
@@ -578,13 +692,206 @@ def count_prompt_tokens(model: Llama, text: str):
     prompt_length = len(tokenized_text)
     return prompt_length
 
+async def build_recall_context(conversation_id, query):
+    """
+    Find messages from other conversations similar to the query and format them to go in
+    front of the newest user message, truncated to fit rag_settings['token_budget'] tokens.
+    """
+    # The excerpts are cut to the token budget with the chat model, and there's nothing to add
+    # them to without one (a dedicated embedding model keeps retrieve() working after an eject)
+    if recall is None or not query or llama_model is None:
+        return None
+    try:
+        # Embedding the query is a forward pass, so keep it off the event loop
+        hits = await asyncio.to_thread(recall.retrieve, query, rag_settings['top_k'],
+                                       exclude_conversation=conversation_id, min_score=rag_settings['min_score'])
+    except Exception as e:
+        print(f"Failed to retrieve from earlier conversations: {e}")
+        return None
+
+    remaining = rag_settings['token_budget']
+    snippets = []
+    for hit_conversation_id, hit_index, score in hits:
+        message = search_index.get_message(hit_conversation_id, hit_index)
+        if message is None or remaining <= 0:
+            continue
+        tokens = llama_model.tokenize(message["text"].encode('utf-8'), add_bos=False)
+        text = message["text"]
+        if len(tokens) > remaining:
+            text = llama_model.detokenize(tokens[:remaining]).decode('utf-8', errors='ignore') + "..."
+        remaining -= min(len(tokens), remaining)
+        speaker = "Assistant" if message["user"] == "bot" else "User"
+        snippets.append(f"- {speaker}: {text}")
+
+    if not snippets:
+        return None
+    return "Relevant excerpts from earlier conversations:\n" + "\n".join(snippets)
+
+# GENERATION TRACING
+# Older app_settings.json files have no "tracing" section, so fall back to the defaults
+tracing_settings = {**default_settings['tracing'], **settings.get('tracing', {})}
+# RotatingFileHandler can't be shared between processes, so each API worker gets its own file
+trace_log_file = os.path.join(logs_dir, f"generation_trace.{os.getpid()}.jsonl" if shared_storage else "generation_trace.jsonl")
+profiles_dir = os.path.join(logs_dir, "profiles")
+
+trace_logger = logging.getLogger("chatbot.trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+if tracing_settings['enabled']:
+    os.makedirs(logs_dir, exist_ok=True)
+    trace_handler = RotatingFileHandler(trace_log_file,
+                                        maxBytes=tracing_settings['max_bytes'],
+                                        backupCount=tracing_settings['backup_count'],
+                                        encoding='utf-8')
+    trace_handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(trace_handler)
+
+class StackSampler:
+    """
+    Sampling profiler for a single thread. A daemon thread periodically grabs the target
+    thread's current frame and counts collapsed stacks, which can be written out in the
+    folded format understood by flamegraph.pl and speedscope.
+    """
+    def __init__(self, thread_id, interval_ms):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+class GenerationTrace:
+    """
+    Collects timings for one generation and writes a single JSON line to the trace log
+    when the `with` block exits. The stop reason defaults to the model's finish_reason;
+    cancellation (websocket closed) and exceptions are recorded as such.
+    """
+    def __init__(self, conversation_id, generation_type):
+        self.record = {
+            "trace_id": str(uuid.uuid4()),
+            "conversation_id": conversation_id,
+            "generation_type": generation_type,
+            "model": current_model.model_name if current_model else None,
+            "prompt_tokens": None,
+            "cache_hit_tokens": None,
+            "completion_tokens": 0,
+            "ttft_ms": None,
+            "total_ms": None,
+            "phases_ms": {},
+            "stop_reason": None,
+        }
+        self.model = None
+        self.cache_before = None
+        self.prompt = None
+        self.sampler = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if tracing_settings['enabled'] and tracing_settings['profile_slow_generations']:
+            # Generation runs on the event loop thread, so that's the one to sample
+            self.sampler = StackSampler(threading.get_ident(), tracing_settings['profile_interval_ms'])
+            self.sampler.start()
+        return self
+
+    def phase(self, name):
+        return _TracePhase(self, name)
+
+    def start_generation(self, model):
+        self.model = model
+        self.cache_before = evaluated_tokens(model)
+        self.generation_start = time.perf_counter()
+
+    def on_token(self):
+        if self.record["ttft_ms"] is None:
+            self.record["ttft_ms"] = round((time.perf_counter() - self.generation_start) * 1000, 2)
+            # The whole prompt has been evaluated by the time the first token comes out
+            self.prompt = evaluated_tokens(self.model)
+        # Number of streamed chunks; end_generation replaces it with the exact count when it can
+        self.record["completion_tokens"] += 1
+
+    def end_generation(self):
+        # Snapshot now; another conversation may use the model before the trace is written
+        if self.prompt is not None:
+            # Streamed chunks can merge several tokens, so count what was evaluated after the prompt
+            self.record["completion_tokens"] = len(evaluated_tokens(self.model)) - len(self.prompt)
+
+    def set_stop_reason(self, reason):
+        self.record["stop_reason"] = reason
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record["total_ms"] = round((time.perf_counter() - self.start) * 1000, 2)
+        if exc_type is not None:
+            if issubclass(exc_type, asyncio.CancelledError):
+                self.record["stop_reason"] = "disconnected"
+            else:
+                self.record["stop_reason"] = "error"
+                self.record["error"] = str(exc)
+
+        if self.prompt is not None:
+            self.record["prompt_tokens"] = len(self.prompt)
+            if self.cache_before is not None:
+                self.record["cache_hit_tokens"] = longest_token_prefix(self.cache_before, self.prompt)
+        elif getattr(self.model, 'prompt_stats', None):
+            # Inference workers measure these next to the model and send them with the last chunk
+            self.record.update(self.model.prompt_stats)
+
+        if self.sampler is not None:
+            self.sampler.stop()
+            if self.record["total_ms"] >= tracing_settings['slow_threshold_ms']:
+                os.makedirs(profiles_dir, exist_ok=True)
+                profile_path = os.path.join(profiles_dir, f"{self.record['trace_id']}.folded")
+                self.sampler.write_folded(profile_path)
+                self.record["profile"] = profile_path
+
+        if tracing_settings['enabled']:
+            try:
+                trace_logger.info(serializer.dumps(self.record))
+            except Exception as e:
+                print(f"Failed to write generation trace: {e}")
+        return False
+
+class _TracePhase:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        phases = self.trace.record["phases_ms"]
+        elapsed = (time.perf_counter() - self.start) * 1000
+        phases[self.name] = round(phases.get(self.name, 0) + elapsed, 2)
+        return False
+
 @app.get("/conversations/{conversation_id}/tokens")
 async def get_total_tokens(conversation_id: str):
     filename = get_conversation_filename(conversation_id)
     file_path = os.path.join(conversations_dir, filename)
     
-    with open(file_path, 'r') as f:
-        conversation = json.load(f)
+    conversation = serializer.load(file_path)
     
     # Calculate the total length of all messages
     total_length = sum(message['length'] for message in conversation['messages'])
@@ -615,105 +922,126 @@ async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
             print("Recieved regenerate signal")
             await regenerate_message(message['messageIndex'])
 
-    async def regenerate_message(message_index):
-        nonlocal is_generating, bot_response_text, generation_type, global_message_index
-        filename = get_conversation_filename(conversation_id)
-        file_path = os.path.join(conversations_dir, filename)
-        global_message_index = message_index
-        with open(file_path, 'r') as f:
-            conversation = json.load(f)
-
-        formatted_messages = [{"role": "system", "content": chat_params.system_prompt}]
-        for idx, msg in enumerate(conversation["messages"][:message_index]):
-            role = "user" if msg["user"] != "bot" else "assistant"
-            formatted_messages.append({"role": role, "content": msg["text"]})
-
-        try:
-            llama_response = llama_model.create_chat_completion(messages=formatted_messages,
-                                                                temperature=chat_params.temperature,
-                                                                top_p=chat_params.top_p,
-                                                                top_k=chat_params.top_k,
-                                                                stream=True)
+    async def stream_reply(trace, model, formatted_messages):
+        """
+        Stream a reply from the model to the client, recording it in the trace.
+        Returns the bot message to save, even if the user stopped the generation.
+        """
+        nonlocal is_generating, bot_response_text
+        trace.start_generation(model)
+        with trace.phase('generate'):
+            llama_response = model.create_chat_completion(messages=formatted_messages,
+                                                          temperature=chat_params.temperature,
+                                                          top_p=chat_params.top_p,
+                                                          top_k=chat_params.top_k,
+                                                          stream=True)
             bot_response_text = ""
             is_generating = True
-            async for chunk in async_generator(llama_response):
+            async for chunk in async_generator(llama_response, in_thread=worker_pool is not None):
                 if not is_generating:
-                        break
-                delta = chunk['choices'][0]['delta']
+                    trace.set_stop_reason('user_stop')
+                    break
+                choice = chunk['choices'][0]
+                delta = choice['delta']
                 if 'content' in delta:
+                    trace.on_token()
                     bot_response_text += delta['content']
                     await websocket.send_text(delta['content'])
+                if choice.get('finish_reason'):
+                    trace.set_stop_reason(choice['finish_reason'])
+            # Stops an inference worker that is still generating
+            llama_response.close()
+            trace.end_generation()
+
+        with trace.phase('count_tokens'):
+            message_length = await asyncio.to_thread(count_prompt_tokens, model, bot_response_text)
+        return {"user": "bot", "text": bot_response_text, "length": message_length}
+
+    async def end_reply():
+        nonlocal is_generating, bot_response_text
+        if is_generating:
+            await websocket.send_text('GENERATION_COMPLETE')
+        else:
+            await websocket.send_text('GENERATION_STOPPED')
+        bot_response_text = None
+        is_generating = False
 
-            
-            message_length = count_prompt_tokens(llama_model, bot_response_text)
-            # Overwrite the previous message at the specified index
-            conversation["messages"][message_index] = {"user": "bot", "text": bot_response_text, "length": message_length}
-            with open(file_path, 'w') as f:
-                json.dump(conversation, f)
-
-            if is_generating:
-                await websocket.send_text('GENERATION_COMPLETE')
-                bot_response_text = None
-            else:
-                await websocket.send_text('GENERATION_STOPPED')
-                bot_response_text = None
-            is_generating = False
-
-        except Exception as e:
-            await websocket.send_text(f"Failed to get response from LLAMA: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to get response from LLAMA: {e}")
-
-    async def process_user_messages():
-        nonlocal is_generating, bot_response_text, generation_type
-        generation_type = 'response'
-        while True:
-            user_input = await user_message_queue.get()
-
-            filename = get_conversation_filename(conversation_id)
-            file_path = os.path.join(conversations_dir, filename)
-            with open(file_path, 'r') as f:
-                conversation = json.load(f)
-
-            formatted_messages = [{"role": "system", "content": chat_params.system_prompt}]
-            for idx, msg in enumerate(conversation["messages"][:-1]):
-                role = "user" if msg["user"] != "bot" else "assistant"
-                formatted_messages.append({"role": role, "content": msg["text"]})
-            formatted_messages.append({"role": "user", "content": user_input})
+    async def regenerate_message(message_index):
+        nonlocal generation_type, global_message_index
+        refresh_shared_state()
+        with GenerationTrace(conversation_id, 'regenerate') as trace:
+            with trace.phase('load'):
+                filename = get_conversation_filename(conversation_id)
+                file_path = os.path.join(conversations_dir, filename)
+                global_message_index = message_index
+                conversation = serializer.load(file_path)
+
+            with trace.phase('format'):
+                formatted_messages = [{"role": "system", "content": chat_params.system_prompt}]
+                for idx, msg in enumerate(conversation["messages"][:message_index]):
+                    role = "user" if msg["user"] != "bot" else "assistant"
+                    formatted_messages.append({"role": role, "content": msg["text"]})
+
+            with trace.phase('recall'):
+                last_user_text = next((msg["text"] for msg in reversed(conversation["messages"][:message_index])
+                                       if msg["user"] != "bot"), None)
+                recall_context = await build_recall_context(conversation_id, last_user_text)
+                if recall_context:
+                    # Added to the newest user message rather than the system prompt, so the earlier
+                    # turns stay an unchanged prefix that llama.cpp can reuse from the KV cache
+                    last_user_message = next(msg for msg in reversed(formatted_messages) if msg["role"] == "user")
+                    last_user_message["content"] = f"{recall_context}\n\n{last_user_message['content']}"
 
             try:
-                llama_response = llama_model.create_chat_completion(messages=formatted_messages,
-                                                                temperature=chat_params.temperature,
-                                                                top_p=chat_params.top_p,
-                                                                top_k=chat_params.top_k,
-                                                                stream=True)
-                bot_response_text = ""
-                is_generating = True
-                async for chunk in async_generator(llama_response):
-                    if not is_generating:
-                        break
-                    delta = chunk['choices'][0]['delta']
-                    if 'content' in delta:
-                        bot_response_text += delta['content']
-                        await websocket.send_text(delta['content'])
-
-                message_length = count_prompt_tokens(llama_model, bot_response_text)
-                # Save the LLM message to the conversation even if stopped
-                conversation["messages"].append({"user": "bot", "text": bot_response_text, "length": message_length})
-                with open(file_path, 'w') as f:
-                    json.dump(conversation, f)
-
-                if is_generating:
-                    await websocket.send_text('GENERATION_COMPLETE')
-                    bot_response_text = None
-                else:
-                    await websocket.send_text('GENERATION_STOPPED')
-                    bot_response_text = None
-                is_generating = False
+                bot_message = await stream_reply(trace, model_for(conversation_id), formatted_messages)
+                with trace.phase('save'):
+                    # Overwrite the previous message at the specified index
+                    update_conversation(conversation_id, lambda c: set_message(c, message_index, bot_message))
+                    index_message(conversation_id, message_index, bot_message)
+                await end_reply()
 
             except Exception as e:
                 await websocket.send_text(f"Failed to get response from LLAMA: {e}")
                 raise HTTPException(status_code=500, detail=f"Failed to get response from LLAMA: {e}")
 
+    async def process_user_messages():
+        nonlocal generation_type
+        generation_type = 'response'
+        while True:
+            user_input = await user_message_queue.get()
+            refresh_shared_state()
+
+            with GenerationTrace(conversation_id, 'response') as trace:
+                with trace.phase('load'):
+                    filename = get_conversation_filename(conversation_id)
+                    file_path = os.path.join(conversations_dir, filename)
+                    conversation = serializer.load(file_path)
+
+                with trace.phase('format'):
+                    formatted_messages = [{"role": "system", "content": chat_params.system_prompt}]
+                    for idx, msg in enumerate(conversation["messages"][:-1]):
+                        role = "user" if msg["user"] != "bot" else "assistant"
+                        formatted_messages.append({"role": role, "content": msg["text"]})
+                    formatted_messages.append({"role": "user", "content": user_input})
+
+                with trace.phase('recall'):
+                    recall_context = await build_recall_context(conversation_id, user_input)
+                    if recall_context:
+                        # Kept out of the system prompt so the earlier turns stay a cached prefix
+                        formatted_messages[-1]["content"] = f"{recall_context}\n\n{user_input}"
+
+                try:
+                    bot_message = await stream_reply(trace, model_for(conversation_id), formatted_messages)
+                    with trace.phase('save'):
+                        # Save the LLM message to the conversation even if stopped
+                        conversation = update_conversation(conversation_id, lambda c: c["messages"].append(bot_message))
+                        index_message(conversation_id, len(conversation["messages"]) - 1, bot_message)
+                    await end_reply()
+
+                except Exception as e:
+                    await websocket.send_text(f"Failed to get response from LLAMA: {e}")
+                    raise HTTPException(status_code=500, detail=f"Failed to get response from LLAMA: {e}")
+
     try:
         if not generation_type:
             message_handler_task = asyncio.create_task(process_user_messages())
@@ -724,7 +1052,7 @@ async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
             if not data:
                 continue
             try:
-                message = json.loads(data)
+                message = serializer.loads(data)
                 await handle_message(message)
             except json.JSONDecodeError as e:
                 print(f"Error decoding JSON: {e}")
@@ -737,18 +1065,15 @@ async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
 
         # Save the in-progress bot response when the WebSocket closes
         if bot_response_text:
-            filename = get_conversation_filename(conversation_id)
-            file_path = os.path.join(conversations_dir, filename)
-            with open(file_path, 'r') as f:
-                conversation = json.load(f)
+            message_length = await asyncio.to_thread(count_prompt_tokens, model_for(conversation_id), bot_response_text)
+            bot_message = {"user": "bot", "text": bot_response_text, "length": message_length}
             if generation_type == 'response':
-                message_length = count_prompt_tokens(llama_model, bot_response_text)
-                conversation["messages"].append({"user": "bot", "text": bot_response_text, "length": message_length})
+                conversation = update_conversation(conversation_id, lambda c: c["messages"].append(bot_message))
+                saved_index = len(conversation["messages"]) - 1
             elif generation_type == 'regenerate':
-                message_length = count_prompt_tokens(llama_model, bot_response_text)
-                conversation["messages"][global_message_index] = {"user": "bot", "text": bot_response_text, "length": message_length}
-            with open(file_path, 'w') as f:
-                json.dump(conversation, f)
+                update_conversation(conversation_id, lambda c: set_message(c, global_message_index, bot_message))
+                saved_index = global_message_index
+            index_message(conversation_id, saved_index, bot_message)
         print(f"Saved in-progress bot response to conversation {conversation_id}")
 
 @app.put("/conversations/{conversation_id}/rename")
@@ -756,65 +1081,231 @@ async def rename_conversation(conversation_id: str, conversation: Conversation):
     if is_conversation_name_taken(conversation.name):
         raise HTTPException(status_code=400, detail="Conversation name already exists")
 
-    index = read_index()
-    filename = index.get(conversation_id)
-    if not filename:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    with storage_lock:
+        index = read_index()
+        filename = index.get(conversation_id)
+        if not filename:
+            raise HTTPException(status_code=404, detail="Conversation not found")
 
-    old_file_path = os.path.join(conversations_dir, filename)
-    new_filename = f"{conversation.name}.json"
-    new_file_path = os.path.join(conversations_dir, new_filename)
+        old_file_path = os.path.join(conversations_dir, filename)
+        new_filename = f"{conversation.name}.json"
+        new_file_path = os.path.join(conversations_dir, new_filename)
 
-    if os.path.exists(new_file_path):
-        raise HTTPException(status_code=400, detail="Conversation name already exists")
+        if os.path.exists(new_file_path):
+            raise HTTPException(status_code=400, detail="Conversation name already exists")
 
-    os.rename(old_file_path, new_file_path)
-    index[conversation_id] = new_filename
-    write_index(index)
+        os.rename(old_file_path, new_file_path)
+        index[conversation_id] = new_filename
+        write_index(index)
 
-    # Load the conversation to update the name
-    with open(new_file_path, 'r') as f:
-        conv_data = json.load(f)
-    conv_data['name'] = conversation.name
+        # Load the conversation to update the name
+        conv_data = serializer.load(new_file_path)
+        conv_data['name'] = conversation.name
 
-    with open(new_file_path, 'w') as f:
-        json.dump(conv_data, f)
+        serializer.dump(conv_data, new_file_path)
 
     return {"id": conversation_id, "name": conversation.name}
 
 @app.put("/conversations/{conversation_id}/messages/{message_index}")
 async def edit_message(conversation_id: str, message_index: int, message: Message = Body(...)):
-    filename = get_conversation_filename(conversation_id)
-    file_path = os.path.join(conversations_dir, filename)
-    
-    with open(file_path, 'r') as f:
-        conversation = json.load(f)
-    
-    if message_index < 0 or message_index >= len(conversation["messages"]):
-        raise HTTPException(status_code=400, detail="Invalid message index")
-    message_length = count_prompt_tokens(llama_model, message.text)
-    conversation["messages"][message_index] = {"user": message.user, "text": message.text, "length": message_length}
-    
-    with open(file_path, 'w') as f:
-        json.dump(conversation, f)
+    message_length = await asyncio.to_thread(count_prompt_tokens, llama_model, message.text)
+    edited_message = {"user": message.user, "text": message.text, "length": message_length}
+
+    def replace_message(conversation):
+        if message_index < 0 or message_index >= len(conversation["messages"]):
+            raise HTTPException(status_code=400, detail="Invalid message index")
+        conversation["messages"][message_index] = edited_message
+
+    conversation = update_conversation(conversation_id, replace_message)
+    index_message(conversation_id, message_index, edited_message)
     
     return conversation
 
 @app.delete("/conversations/{conversation_id}")
 async def delete_conversation(conversation_id: str):
-    filename = get_conversation_filename(conversation_id)
-    file_path = os.path.join(conversations_dir, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    with storage_lock:
+        filename = get_conversation_filename(conversation_id)
+        file_path = os.path.join(conversations_dir, filename)
+        if not os.path.exists(file_path):
+            raise HTTPException(status_code=404, detail="Conversation not found")
 
-    os.remove(file_path)
+        os.remove(file_path)
 
-    # Remove conversation from index
-    index = read_index()
-    del index[conversation_id]
-    write_index(index)
+        # Remove conversation from index
+        index = read_index()
+        del index[conversation_id]
+        write_index(index)
+    forget_conversation(conversation_id)
 
     return {"message": "Conversation deleted successfully"}
 
+@app.get("/search")
+async def search_conversations(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=200)):
+    # Matches are ranked by bm25; snippets are HTML-escaped, with matched words wrapped in <mark></mark>
+    return search_index.search(q, limit)
+
+# IMPORT / EXPORT
+# Archives are gzip-compressed JSON Lines, one conversation per line, so both directions
+# can be streamed with only one conversation in memory at a time.
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+IMPORT_BATCH_SIZE = 100
+GZIP_MAGIC = b"\x1f\x8b"
+
+def iter_export(conversation_ids):
+    index = read_index()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for conversation_id in conversation_ids:
+        filename = index.get(conversation_id)
+        if filename is None:
+            continue
+        try:
+            with open(os.path.join(conversations_dir, filename), 'rb') as f:
+                data = f.read().strip()
+        except FileNotFoundError:
+            print(f"Skipping missing conversation file {filename}")
+            continue
+        # Conversation files are written without indentation, so they are already one line
+        if b"\n" in data:
+            data = serializer.dumps_bytes(serializer.loads(data))
+        chunk = compressor.compress(data + b"\n")
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+@app.get("/export")
+async def export_conversations(ids: list[str] = Query(None)):
+    conversation_ids = ids if ids else list(read_index().keys())
+    return StreamingResponse(iter_export(conversation_ids),
+                             media_type="application/gzip",
+                             headers={"Content-Disposition": 'attachment; filename="conversations.jsonl.gz"'})
+
+class GzipMembers:
+    """
+    Incremental gzip decoder that handles concatenated members (`cat a.gz b.gz`), which a
+    single zlib decompressobj stops reading after the first one.
+    """
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(31)
+        self.started = False
+
+    def decompress(self, data):
+        out = bytearray()
+        while data:
+            if self.decompressor.eof:
+                # Some tools pad the end of an archive with zero bytes
+                if not data.strip(b"\0"):
+                    break
+                self.decompressor = zlib.decompressobj(31)
+            self.started = True
+            out += self.decompressor.decompress(data)
+            data = self.decompressor.unused_data if self.decompressor.eof else b""
+        return out
+
+    def finish(self):
+        out = self.decompressor.flush()
+        if self.started and not self.decompressor.eof:
+            raise zlib.error("archive is truncated")
+        return out
+
+async def iter_import_lines(file: UploadFile):
+    # Accepts both gzip-compressed and plain JSON Lines. Raises zlib.error for a corrupt archive.
+    decompressor = None
+    pending = bytearray()
+    while True:
+        chunk = await file.read(ARCHIVE_CHUNK_SIZE)
+        if not chunk:
+            break
+        if decompressor is None:
+            decompressor = GzipMembers() if chunk.startswith(GZIP_MAGIC) else False
+        # Only the new data can contain the next newline, so a long line isn't rescanned per chunk
+        search_from = len(pending)
+        pending += decompressor.decompress(chunk) if decompressor else chunk
+        start = 0
+        while True:
+            end = pending.find(b"\n", search_from)
+            if end < 0:
+                break
+            line = pending[start:end]
+            if line.strip():
+                yield bytes(line)
+            start = search_from = end + 1
+        del pending[:start]
+    if decompressor:
+        pending += decompressor.finish()
+    if pending.strip():
+        yield bytes(pending)
+
+def estimate_message_length(text):
+    if llama_model is not None:
+        return count_prompt_tokens(llama_model, text)
+    # Rough estimate until a model is loaded to count with
+    return len(text) // 4
+
+def save_imported_batch(batch, index, recount_tokens):
+    for conversation in batch:
+        for message in conversation["messages"]:
+            if recount_tokens or "length" not in message:
+                message["length"] = estimate_message_length(message["text"])
+    with storage_lock:
+        # Re-read so conversations created by other API workers during the import are kept
+        index.clear()
+        index.update(read_index())
+        for conversation in batch:
+            filename = index.get(conversation["id"], f"conversation_{conversation['id']}.json")
+            serializer.dump(conversation, os.path.join(conversations_dir, filename))
+            index[conversation["id"]] = filename
+        write_index(index)
+    index_conversations(batch)
+
+@app.post("/import")
+async def import_conversations(file: UploadFile = File(...), overwrite: bool = False, recount_tokens: bool = False):
+    index = read_index()
+    imported = 0
+    skipped = 0
+    errors = []
+    batch = []
+    seen = set()
+    line_number = 0
+
+    try:
+        async for line in iter_import_lines(file):
+            line_number += 1
+            try:
+                data = serializer.loads(line)
+                conversation = {
+                    "id": str(data["id"]),
+                    "name": str(data["name"]),
+                    "messages": [{"user": str(m["user"]), "text": str(m["text"]), **({"length": int(m["length"])} if "length" in m else {})}
+                                 for m in data["messages"]],
+                }
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                if len(errors) < 20:
+                    errors.append(f"Line {line_number}: {e}")
+                continue
+
+            # The id ends up in a file name, so only accept the characters uuids use
+            if not re.fullmatch(r"[\w-]+", conversation["id"]):
+                conversation["id"] = str(uuid.uuid4())
+            if conversation["id"] in seen or (conversation["id"] in index and not overwrite):
+                skipped += 1
+                continue
+
+            seen.add(conversation["id"])
+            batch.append(conversation)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                # Tokenizing, writing the files and indexing take a while; keep other requests and streams going
+                await asyncio.to_thread(save_imported_batch, batch, index, recount_tokens)
+                imported += len(batch)
+                batch = []
+    except zlib.error as e:
+        # Keep what was read before the damage, like a bad line
+        errors.append(f"Archive is corrupt after line {line_number}: {e}")
+
+    if batch:
+        await asyncio.to_thread(save_imported_batch, batch, index, recount_tokens)
+        imported += len(batch)
+
+    return {"imported": imported, "skipped": skipped, "errors": errors}
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host=launch_args.host, port=launch_args.port)
@@ -16,7 +16,7 @@ a = Analysis(
         (os.path.join(llama_cpp_lib_path, 'llama.lib'), 'llama_cpp'),  # Include the LIB file
     ],
     datas=collect_data_files('llama_cpp') + collect_data_files('llama-cpp-python'),
-    hiddenimports=collect_submodules('llama_cpp') + collect_submodules('llama-cpp-python'),
+    hiddenimports=collect_submodules('llama_cpp') + collect_submodules('llama-cpp-python') + ['main'],  # uvicorn imports "main:app" in multi-worker mode
     hookspath=[],
     runtime_hooks=[],
     excludes=[],
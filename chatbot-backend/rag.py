@@ -0,0 +1,262 @@
+"""
+Recall of earlier conversations for retrieval-augmented generation.
+
+Messages are embedded in the background by a GGUF opened in embedding mode (a dedicated
+embedding model, or another instance of the chat model), kept on the CPU unless
+configured otherwise so it doesn't take a second copy of the chat model's VRAM. They are
+stored as normalized float32 rows in a memory-mapped .npy file, so cosine similarity is a
+single matrix-vector product. Only (conversation_id, message_index) keys are kept next to
+the vectors; the message text is looked up in the search index when building the prompt.
+"""
+import os
+import queue
+import threading
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+
+import serializer
+
+INITIAL_CAPACITY = 1024
+
+
+class VectorIndex:
+    def __init__(self, directory):
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.meta_path = os.path.join(directory, "vectors_meta.json")
+        self._lock = threading.Lock()
+        self.model = None
+        self.keys = []           # row -> [conversation_id, message_index], or None once deleted
+        self.rows = {}           # (conversation_id, message_index) -> row
+        self.vectors = None      # memmap of shape (capacity, dim)
+        self.row_conversation = np.zeros(0, dtype=np.int32)  # row -> conversation code, -1 if deleted
+        self.conversation_codes = {}
+
+        if os.path.exists(self.meta_path) and os.path.exists(self.vectors_path):
+            try:
+                meta = serializer.load(self.meta_path)
+                self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+                self.model = meta["model"]
+                self.keys = meta["keys"][:len(self.vectors)]
+                self._rebuild_lookups()
+            except Exception as e:
+                print(f"Failed to load vector index, starting empty: {e}")
+                self.model, self.keys, self.vectors = None, [], None
+                self._rebuild_lookups()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _rebuild_lookups(self):
+        self.rows = {}
+        self.conversation_codes = {}
+        capacity = len(self.vectors) if self.vectors is not None else 0
+        self.row_conversation = np.full(capacity, -1, dtype=np.int32)
+        for row, key in enumerate(self.keys):
+            if key is not None:
+                self.rows[tuple(key)] = row
+                self.row_conversation[row] = self._code(key[0])
+
+    def _code(self, conversation_id):
+        return self.conversation_codes.setdefault(conversation_id, len(self.conversation_codes))
+
+    def reset(self, model, dim):
+        with self._lock:
+            self.model = model
+            self.keys = []
+            self.vectors = None
+            self._allocate(INITIAL_CAPACITY, dim)
+            self._rebuild_lookups()
+            self._save_meta()
+
+    def _allocate(self, capacity, dim):
+        tmp_path = self.vectors_path + ".tmp"
+        vectors = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(capacity, dim))
+        if self.vectors is not None:
+            vectors[:len(self.vectors)] = self.vectors
+        vectors.flush()
+        del vectors
+        # Release the old mapping before replacing the file (required on Windows)
+        self.vectors = None
+        os.replace(tmp_path, self.vectors_path)
+        self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+        grown = np.full(capacity, -1, dtype=np.int32)
+        grown[:len(self.row_conversation)] = self.row_conversation
+        self.row_conversation = grown
+
+    def add(self, keys, vectors):
+        """
+        Insert or replace the vectors for the given (conversation_id, message_index) keys.
+        Call save() afterwards to persist the key list.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                key = tuple(key)
+                row = self.rows.get(key)
+                if row is None:
+                    row = len(self.keys)
+                    if row >= len(self.vectors):
+                        self._allocate(len(self.vectors) * 2, self.vectors.shape[1])
+                    self.keys.append(list(key))
+                    self.rows[key] = row
+                    self.row_conversation[row] = self._code(key[0])
+                self.vectors[row] = vector
+
+    def save(self):
+        with self._lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+            self._save_meta()
+
+    def remove_conversation(self, conversation_id):
+        with self._lock:
+            code = self.conversation_codes.get(conversation_id)
+            if code is None:
+                return
+            for row in np.nonzero(self.row_conversation == code)[0]:
+                del self.rows[tuple(self.keys[row])]
+                self.keys[row] = None
+            self.row_conversation[self.row_conversation == code] = -1
+            self._save_meta()
+
+    def search(self, query_vector, k, exclude_conversation=None, min_score=0.0):
+        """Top-k (conversation_id, message_index, score) by cosine similarity."""
+        with self._lock:
+            n = len(self.keys)
+            if n == 0:
+                return []
+            query_vector = np.asarray(query_vector, dtype=np.float32)
+            query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+            scores = self.vectors[:n] @ query_vector
+            excluded = self.row_conversation[:n] == -1
+            if exclude_conversation in self.conversation_codes:
+                excluded |= self.row_conversation[:n] == self.conversation_codes[exclude_conversation]
+            scores[excluded] = -np.inf
+            k = min(k, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.keys[row][0], self.keys[row][1], float(scores[row]))
+                    for row in top if scores[row] >= min_score]
+
+    def _save_meta(self):
+        serializer.dump({"model": self.model, "keys": self.keys}, self.meta_path)
+
+
+class Recall:
+    """
+    Owns the embedding model and a background thread that embeds queued messages in
+    batches. All calls into the embedding model are serialized by a lock, since a llama
+    context can't be used from two threads at once. Query embeddings go first: the
+    background thread waits for pending retrieve() calls before starting its next batch.
+    """
+    def __init__(self, directory, batch_size=16, all_messages=None):
+        os.makedirs(directory, exist_ok=True)
+        self.index = VectorIndex(directory)
+        self.batch_size = batch_size
+        self.all_messages = all_messages
+        self.embedder = None
+        self.model_name = None
+        self._embed_lock = threading.Lock()
+        self._pending_queries = 0
+        self._queries_done = threading.Condition()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def ready(self):
+        return self.embedder is not None
+
+    def set_model(self, model_name, model_path, n_gpu_layers=0):
+        self._queue.put(("load", model_name, model_path, n_gpu_layers))
+
+    def unload(self):
+        self._queue.put(("unload",))
+
+    def enqueue(self, conversation_id, message_index, text):
+        if not text.strip():
+            return
+        self._queue.put(("embed", conversation_id, message_index, text))
+
+    def remove_conversation(self, conversation_id):
+        self.index.remove_conversation(conversation_id)
+
+    def embed(self, texts):
+        with self._embed_lock:
+            if self.embedder is None:
+                raise RuntimeError("No embedding model loaded")
+            embeddings = self.embedder.embed(texts, truncate=True)
+        # Models without a pooling layer return one vector per token
+        return np.stack([np.mean(np.asarray(e, dtype=np.float32).reshape(-1, np.shape(e)[-1]), axis=0)
+                         for e in embeddings])
+
+    def retrieve(self, query, k, exclude_conversation=None, min_score=0.0):
+        # Skip while a newly loaded model's index is still being reset
+        if not self.ready or self.index.model != self.model_name or len(self.index) == 0:
+            return []
+        with self._queries_done:
+            self._pending_queries += 1
+        try:
+            query_vector = self.embed([query])[0]
+        finally:
+            with self._queries_done:
+                self._pending_queries -= 1
+                self._queries_done.notify_all()
+        return self.index.search(query_vector, k, exclude_conversation, min_score)
+
+    def _load(self, model_name, model_path, n_gpu_layers):
+        model_kwargs = {"model_path": model_path, "embedding": True, "n_gpu_layers": n_gpu_layers, "verbose": False}
+        pooling = getattr(llama_cpp, "LLAMA_POOLING_TYPE_MEAN", None)
+        if pooling is not None:
+            model_kwargs["pooling_type"] = pooling
+        with self._embed_lock:
+            self.embedder = None
+            self.embedder = Llama(**model_kwargs)
+            self.model_name = model_name
+
+        # Vectors from a different model aren't comparable, so start over
+        if self.index.model != model_name:
+            dim = self.embed(["dimension probe"]).shape[1]
+            self.index.reset(model_name, dim)
+
+        # Backfill anything that was saved while no embedding model was loaded
+        if self.all_messages is not None:
+            for conversation_id, message_index, text in self.all_messages():
+                if (conversation_id, message_index) not in self.index.rows:
+                    self.enqueue(conversation_id, message_index, text)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item[0] == "load":
+                    self._load(*item[1:])
+                elif item[0] == "unload":
+                    with self._embed_lock:
+                        self.embedder = None
+                        self.model_name = None
+                elif item[0] == "embed":
+                    batch = [item]
+                    # Drain whatever else is waiting, up to one batch
+                    while len(batch) < self.batch_size:
+                        try:
+                            next_item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if next_item[0] != "embed":
+                            self._queue.put(next_item)
+                            break
+                        batch.append(next_item)
+                    if self.embedder is not None:
+                        with self._queries_done:
+                            self._queries_done.wait_for(lambda: self._pending_queries == 0)
+                        vectors = self.embed([text for _, _, _, text in batch])
+                        self.index.add([(cid, idx) for _, cid, idx, _ in batch], vectors)
+                        # Writing the key list is O(n), so only do it once the backlog is drained
+                        if self._queue.empty():
+                            self.index.save()
+            except Exception as e:
+                print(f"Recall worker error: {e}")
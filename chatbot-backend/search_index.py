@@ -0,0 +1,180 @@
+"""
+Full-text search over conversation messages, backed by SQLite FTS5.
+
+Messages are stored in a plain table keyed by (conversation_id, message_index) and
+mirrored into an FTS5 index by triggers, so a single message can be replaced or removed
+without rescanning the whole index. The JSON conversation files stay the source of
+truth; sync() reconciles the database with index.json on startup, reindexing any
+conversation whose file changed since it was last synced.
+"""
+import html
+import os
+import re
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    message_index INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (conversation_id, message_index)
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+# Control characters that don't occur in chat text mark the matches in snippet(), so the
+# message text around them can be HTML-escaped before they become <mark> tags
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+UPSERT = """
+INSERT INTO messages (conversation_id, message_index, user, text) VALUES (?, ?, ?, ?)
+ON CONFLICT (conversation_id, message_index) DO UPDATE SET user = excluded.user, text = excluded.text
+"""
+
+
+def build_match_query(query):
+    """
+    Turn free text into an FTS5 query: every word must match, and the last word is
+    treated as a prefix so results show up while the user is still typing.
+    Quoting each word keeps FTS5 operators in user input from being interpreted.
+    """
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and turn its match markers into <mark> tags."""
+    return html.escape(snippet, quote=False).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+
+class SearchIndex:
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        # Databases created before file versions were tracked
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+        if "mtime_ns" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE conversations ADD COLUMN mtime_ns INTEGER")
+                self._conn.execute("ALTER TABLE conversations ADD COLUMN size INTEGER")
+
+    def set_message(self, conversation_id, message_index, message):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO conversations (conversation_id) VALUES (?)", (conversation_id,))
+            self._conn.execute(UPSERT, (conversation_id, message_index, message["user"], message["text"]))
+
+    def index_conversation(self, conversation):
+        """Replace everything indexed for a conversation with its current messages."""
+        self.index_conversations([conversation])
+
+    def index_conversations(self, conversations):
+        """Like index_conversation, but for many conversations in a single transaction."""
+        with self._lock, self._conn:
+            for conversation in conversations:
+                conversation_id = conversation["id"]
+                rows = [(conversation_id, i, msg["user"], msg["text"]) for i, msg in enumerate(conversation["messages"])]
+                self._conn.execute("INSERT OR IGNORE INTO conversations (conversation_id) VALUES (?)", (conversation_id,))
+                self._conn.execute("DELETE FROM messages WHERE conversation_id = ? AND message_index >= ?",
+                                   (conversation_id, len(rows)))
+                self._conn.executemany(UPSERT, rows)
+
+    def delete_conversation(self, conversation_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self._conn.execute("DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,))
+
+    def conversation_ids(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT conversation_id FROM conversations")}
+
+    def sync(self, conversation_paths, load_conversation):
+        """
+        Reindex conversations whose file is missing from the database or has changed
+        since the last sync, and drop ones that no longer exist. conversation_paths maps
+        conversation ids to their files; load_conversation(path) returns the conversation.
+        """
+        with self._lock:
+            versions = {row[0]: (row[1], row[2]) for row in
+                        self._conn.execute("SELECT conversation_id, mtime_ns, size FROM conversations")}
+        for conversation_id in versions.keys() - conversation_paths.keys():
+            self.delete_conversation(conversation_id)
+        for conversation_id, path in conversation_paths.items():
+            try:
+                # Stat before loading, so a write in between gets picked up next time
+                st = os.stat(path)
+                version = (st.st_mtime_ns, st.st_size)
+                if versions.get(conversation_id) == version:
+                    continue
+                self.index_conversation(load_conversation(path))
+                with self._lock, self._conn:
+                    self._conn.execute("UPDATE conversations SET mtime_ns = ?, size = ? WHERE conversation_id = ?",
+                                       (*version, conversation_id))
+            except Exception as e:
+                print(f"Failed to index conversation {conversation_id}: {e}")
+
+    def get_message(self, conversation_id, message_index):
+        with self._lock:
+            row = self._conn.execute("SELECT user, text FROM messages WHERE conversation_id = ? AND message_index = ?",
+                                     (conversation_id, message_index)).fetchone()
+        return {"user": row[0], "text": row[1]} if row else None
+
+    def all_messages(self):
+        """Every indexed message as (conversation_id, message_index, text), in insertion order."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT conversation_id, message_index, text FROM messages ORDER BY id").fetchall()
+
+    def search(self, query, limit=20):
+        match = build_match_query(query)
+        if match is None:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT m.conversation_id, m.message_index, m.user,
+                       snippet(messages_fts, 0, ?, ?, '...', 16),
+                       bm25(messages_fts) AS score
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ?
+                ORDER BY score
+                LIMIT ?
+                """,
+                (MATCH_START, MATCH_END, match, limit),
+            ).fetchall()
+        return [
+            {"conversation_id": conversation_id, "message_index": message_index, "user": user,
+             "snippet": highlight(snippet), "score": -score}
+            for conversation_id, message_index, user, snippet, score in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
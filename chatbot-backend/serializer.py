@@ -0,0 +1,118 @@
+"""
+JSON serialization used by every store in main.py (conversations, index, settings and
+model metadata). The fastest installed backend is picked automatically (orjson, then
+ujson, then the standard library json module) and can be forced with set_backend() or
+the CHATBOT_JSON_BACKEND environment variable.
+
+Decode errors are always raised as json.JSONDecodeError so callers don't need to know
+which backend is active.
+"""
+import json
+import os
+import tempfile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+BACKENDS = ("orjson", "ujson", "json")
+
+# os.umask can only be read by setting it, so do it once at import
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def is_available(name):
+    """Whether the named backend is installed."""
+    if name == "orjson":
+        return orjson is not None
+    if name == "ujson":
+        return ujson is not None
+    return name == "json"
+
+
+def set_backend(name="auto"):
+    """
+    Select the backend by name, or "auto" for the fastest one installed.
+    Falls back to the standard library if the requested backend is missing.
+    """
+    global backend
+    if name == "auto":
+        backend = next(b for b in BACKENDS if is_available(b))
+    elif name in BACKENDS and is_available(name):
+        backend = name
+    else:
+        print(f"JSON backend '{name}' is not available, using the standard library")
+        backend = "json"
+    return backend
+
+
+def dumps_bytes(obj, indent=False):
+    if backend == "orjson":
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return dumps(obj, indent).encode('utf-8')
+
+
+def dumps(obj, indent=False):
+    if backend == "orjson":
+        return dumps_bytes(obj, indent).decode('utf-8')
+    if backend == "ujson":
+        return ujson.dumps(obj, indent=2 if indent else 0, ensure_ascii=False)
+    return json.dumps(obj, indent=2 if indent else None)
+
+
+def loads(data):
+    if backend == "orjson":
+        # orjson.JSONDecodeError already subclasses json.JSONDecodeError
+        return orjson.loads(data)
+    if backend == "ujson":
+        try:
+            return ujson.loads(data)
+        except ValueError as e:
+            doc = data.decode('utf-8', errors='replace') if isinstance(data, bytes) else data
+            raise json.JSONDecodeError(str(e), doc, 0) from e
+    return json.loads(data)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def dump(obj, path, indent=False):
+    write_atomic(path, dumps_bytes(obj, indent))
+
+
+def write_atomic(path, data):
+    """
+    Write to a temporary file next to `path` and rename it into place, so readers
+    never see a truncated file even if the process dies mid-write.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o666 & ~_umask
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        # mkstemp creates the file as 0600; keep the permissions a plain open() would give
+        os.chmod(tmp_path, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            # Make sure the data is on disk before the rename, or a crash could leave an empty file
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+backend = set_backend(os.environ.get("CHATBOT_JSON_BACKEND", "auto"))